@@ -0,0 +1,266 @@
+#!/usr/bin/python3
+
+import sys
+import logging
+import os
+import shutil
+import tempfile
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED, ALL_COMPLETED
+
+from partialAlign2 import chunkBorders
+from ladder2text import readfile, readLadder, ladderToText, pairwise
+from wrapper import Telemetry, run_hunalign
+
+logging.basicConfig(format='%(message)s',level=logging.INFO)
+
+class Document:
+    """A document pair of the manifest and the chunks it was cut into.
+
+    Each chunk is a tuple (huStart, enStart, huFilename, enFilename, ladderFilename),
+    where huStart and enStart are the sentence positions of the chunk in the document."""
+
+    def __init__(self, index, huFilename, enFilename, output):
+        self.index = index
+        self.huFilename = huFilename
+        self.enFilename = enFilename
+        self.output = output
+        self.chunks = []
+        self.pending = 0
+        self.failed = False
+
+def readManifest(filename):
+    """Generates the documents of a manifest, reading it lazily.
+
+    The manifest has one document pair per line, in three tab-separated columns:
+    the file in lang1, the file in lang2 and the name of the aligned text output.
+    Relative paths are relative to the directory of the manifest.
+    A malformed line is logged and generates a document that is already failed."""
+    count = 0
+    manifestDir = os.path.dirname(filename)
+    with open(filename) as manifest:
+        for ind,line in enumerate(manifest):
+            if not line.strip():
+                continue
+            words = line.rstrip('\n').split('\t')
+            if len(words) == 3:
+                doc = Document(count, *[os.path.join(manifestDir, w) for w in words])
+            else:
+                logging.error('Manifest %s has incorrect format in line %d: %s', filename, ind+1, line.rstrip('\n'))
+                doc = Document(count, None, None, None)
+                doc.failed = True
+            yield doc
+            count += 1
+
+def splitDocument(doc, workdir, maximalChunkSize, enc1, enc2, brutal, maxFreq):
+    """Cuts a document pair into chunks using the logic of partialAlign2.py,
+    and writes the chunks into workdir."""
+    with open(doc.huFilename,encoding=enc1) as huFile, open(doc.enFilename,encoding=enc2) as enFile:
+        huCorpus = [l.strip().split() for l in huFile.readlines()]
+        enCorpus = [l.strip().split() for l in enFile.readlines()]
+    sentSizes = ([sum(len(t.encode(enc1))+1 for t in s) for s in huCorpus],[sum(len(t.encode(enc2))+1 for t in s) for s in enCorpus])
+    chain = chunkBorders(huCorpus, enCorpus, maximalChunkSize, sentSizes, brutal, maxFreq=maxFreq)
+
+    lastPos = (0,0)
+    for pos in chain:
+        if pos == lastPos:
+            continue
+        baseFilename = os.path.join(workdir, '%d_%d' % (doc.index, len(doc.chunks)+1))
+        with open(baseFilename + '.1', 'w', encoding=enc1) as huFile:
+            huFile.write(sentenceLines(huCorpus, lastPos[0], pos[0]))
+        with open(baseFilename + '.2', 'w', encoding=enc2) as enFile:
+            enFile.write(sentenceLines(enCorpus, lastPos[1], pos[1]))
+        doc.chunks.append((lastPos[0], lastPos[1], baseFilename + '.1', baseFilename + '.2', baseFilename + '.ladder'))
+        lastPos = pos
+
+def sentenceLines(corpus, start, end):
+    """Return sentences start to end-1 of corpus in text format, like strInterval does,
+    but with each sentence terminated by a line break.
+    hunalign ignores the last sentence of a file without a final line break."""
+    return ''.join(' '.join(line) + '\n' for line in corpus[start:end])
+
+def batches(docs, workdir, packSize, maximalChunkSize, enc1, enc2, brutal, maxFreq):
+    """Generates lists of (document, chunk) jobs of at most packSize items,
+    each of which is aligned by a single hunalign process.
+    Only documents above maximalChunkSize are split."""
+    batch = []
+    for doc in docs:
+        if doc.failed:
+            continue
+        try:
+            size = max(os.path.getsize(doc.huFilename), os.path.getsize(doc.enFilename))
+            if maximalChunkSize > 0 and size > maximalChunkSize:
+                splitDocument(doc, workdir, maximalChunkSize, enc1, enc2, brutal, maxFreq)
+            else:
+                doc.chunks.append((0, 0, doc.huFilename, doc.enFilename,
+                                   os.path.join(workdir, '%d.ladder' % doc.index)))
+        except (OSError, UnicodeError) as e:
+            logging.error('Cannot read %s / %s: %s', doc.huFilename, doc.enFilename, e)
+            doc.failed = True
+            continue
+        doc.pending = len(doc.chunks)
+        for chunk in doc.chunks:
+            batch.append((doc, chunk))
+            if len(batch) == packSize:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+def alignBatch(batchIndex, batch, hunalignArgs, workdir, telemetry):
+    """Runs one hunalign process on a batch of jobs.
+    Returns the set of ladder filenames it could not align."""
+    batchFilename = os.path.join(workdir, 'batch_%d' % batchIndex)
+    with open(batchFilename, 'w') as batchFile:
+        # No newline after the last line, or hunalign complains about the format.
+        batchFile.write('\n'.join('\t'.join(chunk[2:]) for doc,chunk in batch))
+    chunks = run_hunalign(hunalignArgs + ['-batch', batchFilename], 'batch', telemetry, echo=False)
+    os.remove(batchFilename)
+    aligned = set(c['chunk'] for c in chunks if not c['failed'])
+    return set(chunk[4] for doc,chunk in batch) - aligned
+
+def writeDocument(doc, enc1, enc2, outEnc):
+    """Joins the ladders of the chunks of a document and writes its aligned text."""
+    ladder = []
+    for huStart,enStart,huFilename,enFilename,ladderFilename in doc.chunks:
+        rungs = readLadder(ladderFilename)
+        if not rungs:
+            raise ValueError('Ladder %s is empty.' % ladderFilename)
+        if rungs[0][:2] != (0,0):
+            # hunalign may drop the first rung when it postprocesses the start of the trail,
+            # so the sentences before its first rung get a bead of their own.
+            rungs.insert(0, (0,0,'0'))
+        if ladder and ladder[-1][:2] == (huStart,enStart):
+            ladder.pop() # the last rung of a chunk is the first rung of the next one
+        ladder += [(huStart+huPos, enStart+enPos, score) for huPos,enPos,score in rungs]
+    hulines = readfile(doc.huFilename, enc1)
+    enlines = readfile(doc.enFilename, enc2)
+    end = (len(hulines), len(enlines))
+    if (ladder[0][:2] != (0,0) or ladder[-1][0] > end[0] or ladder[-1][1] > end[1]
+            or any(b[0] < a[0] or b[1] < a[1] for a,b in pairwise(ladder))):
+        raise ValueError('Ladder of %s / %s does not fit the documents.' % (doc.huFilename, doc.enFilename))
+    if ladder[-1][:2] != end:
+        # hunalign ignores the last sentence of a file without a final line break,
+        # so the remaining sentences get a bead of their own.
+        ladder.append(end + ('0',))
+    with open(doc.output, 'w', encoding=outEnc) as outFile:
+        for l in ladderToText(ladder, hulines, enlines):
+            outFile.write(l + '\n')
+
+def finishDocument(doc, args):
+    """Writes the aligned text of a document whose chunks are all aligned.
+    Returns True on success."""
+    if not doc.failed:
+        try:
+            writeDocument(doc, args.enc1, args.enc2, args.outenc)
+        except (OSError, UnicodeError, ValueError, AssertionError) as e:
+            logging.error('Cannot write %s: %s', doc.output, e)
+            doc.failed = True
+    else:
+        logging.error('HunAlign failed to align %s / %s.', doc.huFilename, doc.enFilename)
+    if not args.keep:
+        removeChunks(doc)
+    return not doc.failed
+
+def removeChunks(doc):
+    for chunk in doc.chunks:
+        for filename in chunk[2:]:
+            if filename not in (doc.huFilename, doc.enFilename) and os.path.exists(filename):
+                os.remove(filename)
+
+def main() :
+    script_path = os.path.dirname(os.path.realpath(__file__))
+    argParser = ArgumentParser(
+        description='''Aligns many document pairs with hunalign.
+Small document pairs are packed into shared hunalign batch jobs, large ones are first cut into chunks
+like partialAlign2.py does. The batch jobs are distributed among a pool of workers.''',
+        epilog='''The manifest has one document pair per line, with three tab-separated columns:
+the file in lang1, the file in lang2 and the aligned text output file.
+Relative paths are relative to the directory of the manifest. Malformed lines are reported and
+counted as failed document pairs.
+The input files must have one line per sentence. The output is in the format of ladder2text.py,
+and is written as soon as all chunks of a document are aligned.'''
+)
+    argParser.add_argument('-b','--brutal',action='store_true',help='cut large documents in brutal mode, see partialAlign2.py')
+    argParser.add_argument('--rare',type=int,default=0,metavar='K',help='also anchor large documents on tokens occurring at most K times, see partialAlign2.py')
+    argParser.add_argument('--enc',default=None,help='decode input files from ENC')
+    argParser.add_argument('--enc1',default='UTF-8',help='decode files in lang1 from ENC1')
+    argParser.add_argument('--enc2',default='UTF-8',help='decode files in lang2 from ENC2')
+    argParser.add_argument('--outenc',default=None,help='encode the output in OUTENC, defaults to the encoding of the input files if they share one, UTF-8 otherwise')
+    argParser.add_argument('--hunalign',default=os.path.abspath(os.path.join(script_path, '../src/hunalign/hunalign')),help='path to the hunalign executable')
+    argParser.add_argument('--dict',default='/dev/null',help='the hunalign dictionary, defaults to none')
+    argParser.add_argument('--realign',action='store_true',help='make hunalign realign each chunk with a dictionary built from its first alignment')
+    argParser.add_argument('-j','--workers',type=int,default=os.cpu_count(),help='number of hunalign processes run in parallel, defaults to the number of CPUs')
+    argParser.add_argument('--pack',type=int,default=100,help='number of document pairs or chunks aligned by one hunalign process, defaults to 100')
+    argParser.add_argument('--workdir',default=None,help='directory for chunks and ladders, defaults to a temporary directory')
+    argParser.add_argument('--keep',action='store_true',help='keep the chunks and ladders in the work directory')
+    argParser.add_argument('--jsonlog',default=None,help='write per-chunk and per-process telemetry to JSONLOG as JSON lines')
+    argParser.add_argument('--metrics',default=None,help='write per-process metrics to METRICS in Prometheus text format')
+    argParser.add_argument('manifest',help='the list of document pairs to be aligned')
+    argParser.add_argument('maximalChunkSize',type=int,nargs='?',default=5000,metavar='max',help='documents above this byte size are cut into chunks of at most this size, defaults to 5000')
+
+    args = argParser.parse_args()
+
+    if args.enc!=None:
+        args.enc1=args.enc2=args.enc
+    if args.outenc==None:
+        args.outenc = args.enc1 if args.enc1==args.enc2 else 'UTF-8'
+
+    if args.workdir:
+        workdir = args.workdir
+        os.makedirs(workdir, exist_ok=True)
+    else:
+        workdir = tempfile.mkdtemp(prefix='hunalign.')
+
+    hunalignArgs = [args.hunalign]
+    if args.realign:
+        hunalignArgs.append('-realign')
+    hunalignArgs += [args.dict]
+
+    telemetry = Telemetry(args.jsonlog)
+    documents = aligned = 0
+    def counted(docs):
+        nonlocal documents
+        for doc in docs:
+            documents += 1
+            yield doc
+
+    try:
+        with ThreadPoolExecutor(max_workers=args.workers) as pool:
+            futures = {}
+
+            def collect(returnWhen):
+                """Waits for running jobs and writes the documents they complete."""
+                nonlocal aligned
+                done, notDone = wait(futures, return_when=returnWhen)
+                for future in done:
+                    failed = future.result()
+                    for doc,chunk in futures.pop(future):
+                        if chunk[4] in failed:
+                            doc.failed = True
+                        doc.pending -= 1
+                        if doc.pending == 0 and finishDocument(doc, args):
+                            aligned += 1
+
+            # Only a few jobs are queued ahead of the workers, so that documents
+            # are cut, aligned and written while the manifest is being read.
+            for ind,batch in enumerate(batches(counted(readManifest(args.manifest)), workdir, args.pack, args.maximalChunkSize,
+                                               args.enc1, args.enc2, args.brutal, args.rare)):
+                futures[pool.submit(alignBatch, ind, batch, hunalignArgs, workdir, telemetry)] = batch
+                if len(futures) >= 2*args.workers:
+                    collect(FIRST_COMPLETED)
+            if futures:
+                collect(ALL_COMPLETED)
+    finally:
+        telemetry.close()
+        if not args.workdir and not args.keep:
+            shutil.rmtree(workdir)
+    if args.metrics:
+        telemetry.write_metrics(args.metrics, chunks=False)
+
+    logging.info('%d document pairs aligned, %d failed.', aligned, documents - aligned)
+    if aligned < documents:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -4,6 +4,8 @@ import sys
 import collections
 import itertools
 import logging
+import re
+import string
 from argparse import ArgumentParser
 
 logging.basicConfig(format='%(message)s',level=logging.INFO)
@@ -35,6 +37,43 @@ def hapaxPositions( hapaxes, corpus ) :
                 hapaxPos[t] = ind
     return hapaxPos
 
+numeralRe = re.compile(r'\d+([.,]\d+)*')
+
+def normalizeToken(t) :
+    """Returns the form of a token used for matching rare tokens.
+
+    Surrounding punctuation is stripped, and the separators in numerals are unified,
+    so that e.g. 3.14 matches 3,14 and (1999) matches 1999."""
+    t = t.strip(string.punctuation + '«»„“”‘’…')
+    if numeralRe.fullmatch(t) :
+        t = t.replace(',','.')
+    return t
+
+def rareTokenPositions( corpus, maxFreq ) :
+    """Returns a dictionary mapping all normalized tokens occurring at most maxFreq times in corpus
+    to the list of their positions (sentence numbers), in order."""
+    positions = collections.defaultdict(list)
+    for ind,l in enumerate(corpus) :
+        for t in l :
+            t = normalizeToken(t)
+            if t :
+                positions[t].append(ind)
+    return { t:pos for t,pos in positions.items() if len(pos)<=maxFreq }
+
+def rareTokenPairs( huCorpus, enCorpus, maxFreq, minFreq=1 ) :
+    """Returns anchor pairs from the rare tokens shared by the corpora.
+
+    A normalized token is used if it occurs the same number of times, between minFreq and maxFreq,
+    in both corpora. Its occurrences are then paired in order. This catches numbers, identifiers,
+    URLs and names that are not hapaxes, but whose order locates them."""
+    huPos = rareTokenPositions(huCorpus, maxFreq)
+    enPos = rareTokenPositions(enCorpus, maxFreq)
+    pairs = []
+    for t in huPos.keys() & enPos.keys() :
+        if len(huPos[t])==len(enPos[t])>=minFreq :
+            pairs += zip(huPos[t],enPos[t])
+    return pairs
+
 def structurePositions(corpus):
     """Find some structural anchor points.
 
@@ -47,8 +86,8 @@ def structurePositions(corpus):
     keywords += ['<h' + str(i) for i in range(1,7)]
     pos = []
     for ind,sent in enumerate(corpus):
-        if len(sent) == 0:
-            pos.append((kw,ind))
+        if len(sent) == 0: # empty lines separate paragraphs
+            pos.append(('',ind))
         for token in sent:
             for kw in keywords:
                 if token.startswith(kw):
@@ -95,19 +134,33 @@ def maximalChain(pairs,secPairs) :
     The result is a list of sentence index pairs.
     It is very likely that these sentences correspond to each other.
     The input must be in ascending order. This may be achieved with uniqSort.
-    The pairs in the second arguments are only considered if consistent between two primary pairs."""
+    The pairs in the second arguments are only considered if consistent between two primary pairs.
+    Runs in O(n log n) time for n pairs."""
     lattice = {}
-    for p in pairs :
-        bestLength = 0
-        bestPredessor = None
-        for q in pairs :
-            if less(q,p) : # for all anchors occurring before p in both texts
-                length,dummy = lattice[q]
-                if bestLength<length+1 :
-                    bestLength = length+1
-                    bestPredessor = q
-        lattice[p] = (bestLength,bestPredessor)
-        # print bestLength,p,bestPredessor
+    # The best (length, -order, anchor) ending at each second coordinate is kept in a
+    # binary indexed tree of prefix maxima, so that the best predecessor of an anchor is
+    # found in logarithmic time. On ties, the predecessor coming first in pairs wins.
+    enRank = { b:i+1 for i,b in enumerate(sorted(set(p[1] for p in pairs))) }
+    none = (-1,0,None)
+    tree = [none] * (len(enRank)+1)
+    order = 0
+    for huPos,group in itertools.groupby(pairs, key=lambda p:p[0]) :
+        group = list(group)
+        for p in group : # for all anchors occurring before p in both texts
+            best = none
+            i = enRank[p[1]]-1
+            while i>0 :
+                best = max(best,tree[i])
+                i -= i & -i
+            lattice[p] = (best[0]+1,best[2])
+        # anchors sharing a first coordinate may not precede each other
+        for p in group :
+            entry = (lattice[p][0],-order,p)
+            order += 1
+            i = enRank[p[1]]
+            while i<len(tree) :
+                tree[i] = max(tree[i],entry)
+                i += i & -i
     bestLength,p = max( (lattice[p][0],p) for p in pairs )
     chain = []
     while p :
@@ -219,6 +272,64 @@ def selectFromChain( chain, maximalChunkSize, sentSizes, brutal ) : # TODO: impl
     logging.debug('Filtered chain: '+str(filteredChain))
     return filteredChain,forced
 
+def chunkBorders(huCorpus, enCorpus, maximalChunkSize, sentSizes, brutal=False, useHapaxes=True, useTags=True, maxFreq=0) :
+    """Find the borders of chunks of at most maximalChunkSize bytes in a bicorpus.
+
+    The corpora are lists of sentences, which are in turn lists of tokens.
+    sentSizes is a pair of lists holding the byte size of each sentence.
+    If maxFreq is positive, the rare tokens occurring at most maxFreq times
+    are also used as anchors, see rareTokenPairs. Unless useHapaxes is set,
+    tokens occurring only once are left out of them.
+    Returns a list of sentence index pairs, starting with (0,0) and ending
+    with the sizes of the corpora."""
+    if useHapaxes:
+        huFreq = tokenFreq(huCorpus)
+        enFreq = tokenFreq(enCorpus)
+        huHap = hapaxes(huFreq)
+        enHap = hapaxes(enFreq)
+        commonHap = huHap & enHap
+        huPositions = hapaxPositions(huHap,huCorpus)
+        enPositions = hapaxPositions(enHap,enCorpus)
+    
+    # Now we are going to chart hapaxes occurring in both corpora.
+    # We will use them as anchor points later.
+    pairs = []
+    if useHapaxes:
+        for t in commonHap :
+            #       print("%d\t%d\t%s" % (huPositions[t],enPositions[t],t))
+            pairs.append( (huPositions[t],enPositions[t]) )
+    if maxFreq>0:
+        pairs += rareTokenPairs(huCorpus, enCorpus, maxFreq, 1 if useHapaxes else 2)
+
+    pairs.append((0,0)) # Start token (SOF)
+    # by convention, we include this to mark the end of the corpora
+    # luckily it is always < comparable to every other element,
+    # so maximalChain never forgets to include it.
+    # this is not true for (0,0)!
+    corpusSizes = (len(huCorpus),len(enCorpus))
+    pairs.append(corpusSizes) # End token (EOF)
+
+    pairs = uniqSort(pairs)
+    # pairs now contains an ordered list of all anchor mappings.
+
+    # Add some structural anchor points
+    secondaryPairs = (uniqSort(structurePositions(huCorpus)),uniqSort(structurePositions(enCorpus))) if useTags else []
+    
+    logging.info('Computing maximal chain in poset...')
+    chain = maximalChain(pairs,secondaryPairs)
+    logging.info('Done.')
+    logging.info('%d long chain found in %d+%d sized poset.', len(chain), len(pairs), min(len(secondaryPairs[0]),len(secondaryPairs[1])) if secondaryPairs != [] else 0 )
+
+    if maximalChunkSize>0 :
+        logging.info('Selecting at most %d sized chunks...', maximalChunkSize)
+        chain,forced = selectFromChain(chain, maximalChunkSize, sentSizes, brutal)
+        logging.info( '%d chunks selected.', len(chain)-1 )
+        logging.info('Done.')
+        if forced != 0 :
+            logging.error('MaximalChunkSize could not be obeyed.')
+            logging.error('Therefore we had to produce a chunk of size %i.',forced)
+    return chain
+
 def main() :
     argParser = ArgumentParser(
         description='''A preprocessor for hunalign.
@@ -234,6 +345,7 @@ hunalign dictionary.dic -batch hunalign_batch'''
     argParser.add_argument('--enc',default=None,help='decode input files from ENC')
     argParser.add_argument('--enc1',default='UTF-8',help='decode file1 from ENC1') #test file has iso8859
     argParser.add_argument('--enc2',default='UTF-8',help='decode file2 from ENC2')
+    argParser.add_argument('--rare',type=int,default=0,metavar='K',help='also use tokens occurring at most K times in both files as anchors, matching their occurrences in order; numerals and punctuation are normalized. With --no-hapaxes, tokens occurring once are not used. Defaults to 0 (off)')
     sepCritArgs = argParser.add_argument_group('Separating criteria','Disable specific criteria for splitting heuristics.')
     sepCritArgs.add_argument('--no-hapaxes',action='store_true',default=False,help='Ignore parallel hapaxes')
     sepCritArgs.add_argument('--no-tags',action='store_true',default=False,help='Ignore parallel HTML and LaTeX structuring tags')
@@ -260,51 +372,8 @@ hunalign dictionary.dic -batch hunalign_batch'''
     # tokens. Note that issues such as letter case and punctuation
     # aren't handled at all, so use with a raw corpus is not encouraged.
 
-    if not args.no_hapaxes:
-        huFreq = tokenFreq(huCorpus)
-        enFreq = tokenFreq(enCorpus)
-        huHap = hapaxes(huFreq)
-        enHap = hapaxes(enFreq)
-        commonHap = huHap & enHap
-        huPositions = hapaxPositions(huHap,huCorpus)
-        enPositions = hapaxPositions(enHap,enCorpus)
     sentSizes = ([sum(len(t.encode(args.enc1))+1 for t in s) for s in huCorpus],[sum(len(t.encode(args.enc2))+1 for t in s) for s in enCorpus]) # in bytes, including WS
-
-    # Now we are going to chart hapaxes occurring in both corpora.
-    # We will use them as anchor points later.
-    pairs = []
-    if not args.no_hapaxes:
-        for t in commonHap :
-            #       print("%d\t%d\t%s" % (huPositions[t],enPositions[t],t))
-            pairs.append( (huPositions[t],enPositions[t]) )
-
-    pairs.append((0,0)) # Start token (SOF)
-    # by convention, we include this to mark the end of the corpora
-    # luckily it is always < comparable to every other element,
-    # so maximalChain never forgets to include it.
-    # this is not true for (0,0)!
-    corpusSizes = (len(huCorpus),len(enCorpus))
-    pairs.append(corpusSizes) # End token (EOF)
-
-    pairs = uniqSort(pairs)
-    # pairs now contains an ordered list of all anchor mappings.
-
-    # Add some structural anchor points
-    secondaryPairs = (uniqSort(structurePositions(huCorpus)),uniqSort(structurePositions(enCorpus))) if not args.no_tags else []
-    
-    logging.info('Computing maximal chain in poset...')
-    chain = maximalChain(pairs,secondaryPairs)
-    logging.info('Done.')
-    logging.info('%d long chain found in %d+%d sized poset.', len(chain), len(pairs), min(len(secondaryPairs[0]),len(secondaryPairs[1])) if secondaryPairs != [] else 0 )
-
-    if args.maximalChunkSize>0 :
-        logging.info('Selecting at most %d sized chunks...', args.maximalChunkSize)
-        chain,forced = selectFromChain(chain, args.maximalChunkSize, sentSizes, args.brutal)
-        logging.info( '%d chunks selected.', len(chain)-1 )
-        logging.info('Done.')
-        if forced != 0 :
-            logging.error('MaximalChunkSize could not be obeyed.')
-            logging.error('Therefore we had to produce a chunk of size %i.',forced)
+    chain = chunkBorders(huCorpus, enCorpus, args.maximalChunkSize, sentSizes, args.brutal, not args.no_hapaxes, not args.no_tags, args.rare)
 
     debug = False
     if debug :
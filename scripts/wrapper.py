@@ -6,6 +6,12 @@ import itertools
 import logging
 import subprocess
 import os
+import re
+import json
+import time
+import threading
+
+from ladder2text import readLadder, pairwise
 
 logging.basicConfig(format='%(message)s',level=logging.INFO)
 
@@ -18,68 +24,376 @@ def mangle_args(args):
     hunalign = os.path.abspath(os.path.join(script_path, "../src/hunalign/hunalign"))
     realign = False
     accumulate = False
+    selective = False
+    threshold = 0.5
+    maxrun = 5
+    jsonlog = None
+    metrics = None
 
     def extract(arg):
         """If arg is an argument intended for this script, its
         value is noted and False is returned. True is returned
         otherwise."""
+        nonlocal partialAlign, hunalign, realign, accumulate, selective
+        nonlocal threshold, maxrun, jsonlog, metrics
         if len(arg) < 3:
             return True
         elif arg.startswith("--partialAlign="):
             partialAlign = arg.replace("--partialAlign=", "")
         elif arg.startswith("--hunalign="):
             hunalign = arg.replace("--hunalign=", "")
+        elif arg.startswith("--threshold="):
+            threshold = float(arg.replace("--threshold=", ""))
+        elif arg.startswith("--maxrun="):
+            maxrun = int(arg.replace("--maxrun=", ""))
+        elif arg.startswith("--jsonlog="):
+            jsonlog = arg.replace("--jsonlog=", "")
+        elif arg.startswith("--metrics="):
+            metrics = arg.replace("--metrics=", "")
         elif "--realign".startswith(arg):
             realign = True
         elif "--accumulate".startswith(arg):
             realign = True
             accumulate = True
+        elif "--selective".startswith(arg):
+            realign = True
+            selective = True
         else:
             return True
         return False
-    
+
     mangled = [arg for arg in args if extract(arg)]
 
     # If help is asked for, don't return any arguments
     if any(arg in args for arg in ("--help", "-help", "-?")):
         mangled = None
 
-    return mangled, partialAlign, hunalign, realign, accumulate
+    return (mangled, partialAlign, hunalign, realign, accumulate,
+            selective, threshold, maxrun, jsonlog, metrics)
+
+class Telemetry:
+    """Collects per-chunk and per-process records of hunalign runs.
+
+    Every record is a dict. Records are appended to a JSON-lines log
+    as soon as they are complete (if a log file is given), and are
+    kept in memory so that a Prometheus text-format metrics file can
+    be written at the end. Records may come from several threads."""
+
+    def __init__(self, jsonlog=None):
+        self.chunks = []
+        self.processes = []
+        self.log = open(jsonlog, "w") if jsonlog else None
+        self.lock = threading.Lock()
+
+    def record(self, rec):
+        with self.lock:
+            if rec["event"] == "chunk":
+                self.chunks.append(rec)
+            else:
+                self.processes.append(rec)
+            if self.log:
+                self.log.write(json.dumps(rec, sort_keys=True) + "\n")
+                self.log.flush()
+
+    def close(self):
+        if self.log:
+            self.log.close()
+            self.log = None
+
+    def failed_chunks(self):
+        return [c for c in self.chunks if c["failed"]]
+
+    def write_metrics(self, filename, chunks=True):
+        """Writes all collected records in Prometheus text format.
+        Per-chunk series are left out if chunks is False.
+
+        The file is written under a temporary name and renamed, so
+        a textfile collector never sees it half-written."""
+        metrics = collections.OrderedDict()
+        def add(name, help, labels, value):
+            if value is None:
+                return
+            if name not in metrics:
+                metrics[name] = (help, [])
+            metrics[name][1].append((labels, value))
+
+        for c in (self.chunks if chunks else []):
+            labels = (("stage", c["stage"]), ("chunk", c["chunk"]))
+            add("hunalign_chunk_quality",
+                "Global quality of the chunk alignment as reported by hunalign.",
+                labels, c["quality"])
+            add("hunalign_chunk_duration_seconds",
+                "Wall time hunalign spent on the chunk.",
+                labels, c["wall_time"])
+            add("hunalign_chunk_sentences",
+                "Number of sentences read from one side of the chunk.",
+                labels + (("side", "1"),), c["sentences"][0])
+            add("hunalign_chunk_sentences",
+                "Number of sentences read from one side of the chunk.",
+                labels + (("side", "2"),), c["sentences"][1])
+            add("hunalign_chunk_failed",
+                "1 if hunalign could not align the chunk, 0 otherwise.",
+                labels, int(c["failed"]))
+
+        # Processes of the same stage are summed up, so that the number
+        # of series does not grow with the number of hunalign runs.
+        stages = collections.OrderedDict()
+        for p in self.processes:
+            if p["stage"] not in stages:
+                stages[p["stage"]] = dict(processes=0, wall_time=0.0, user_time=0.0,
+                                          system_time=0.0, max_rss=0, chunks=0,
+                                          chunks_failed=0, sentences=0)
+            stage = stages[p["stage"]]
+            stage["processes"] += 1
+            stage["max_rss"] = max(stage["max_rss"], p["max_rss"])
+            for key in ("wall_time", "user_time", "system_time", "chunks",
+                        "chunks_failed", "sentences"):
+                stage[key] += p[key]
+
+        for name, stage in stages.items():
+            labels = (("stage", name),)
+            add("hunalign_processes",
+                "Number of hunalign processes run.",
+                labels, stage["processes"])
+            add("hunalign_process_duration_seconds",
+                "Wall time of the hunalign processes.",
+                labels, stage["wall_time"])
+            add("hunalign_process_cpu_seconds",
+                "CPU time used by the hunalign processes.",
+                labels + (("mode", "user"),), stage["user_time"])
+            add("hunalign_process_cpu_seconds",
+                "CPU time used by the hunalign processes.",
+                labels + (("mode", "system"),), stage["system_time"])
+            add("hunalign_process_max_rss_bytes",
+                "Maximum resident set size of the largest hunalign process.",
+                labels, stage["max_rss"])
+            add("hunalign_process_chunks",
+                "Number of chunks processed by hunalign.",
+                labels, stage["chunks"])
+            add("hunalign_process_chunks_failed",
+                "Number of chunks hunalign could not align.",
+                labels, stage["chunks_failed"])
+            add("hunalign_process_sentences_per_second",
+                "Sentences (both sides) aligned per second of hunalign wall time.",
+                labels, stage["sentences"] / stage["wall_time"] if stage["wall_time"] > 0 else None)
+
+        tmp_filename = filename + ".tmp"
+        with open(tmp_filename, "w") as metrics_file:
+            for name, (help, samples) in metrics.items():
+                metrics_file.write("# HELP {0} {1}\n".format(name, help))
+                metrics_file.write("# TYPE {0} gauge\n".format(name))
+                for labels, value in samples:
+                    label_str = ",".join('{0}="{1}"'.format(k, escape_label(v))
+                                         for k, v in labels)
+                    metrics_file.write("{0}{{{1}}} {2}\n".format(name, label_str, value))
+        os.replace(tmp_filename, filename)
+
+def escape_label(value):
+    """Escapes a Prometheus label value."""
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+# The lines of hunalign's stderr that we are interested in, see alignerTool.cpp
+processing_re = re.compile(r"^Processing (.*)$")
+sentences_re = re.compile(r"^(\d+) (hungarian|english) sentences read\.$")
+quality_re = re.compile(r"^Quality\t(.*)\t(\S+)$")
+failed_re = re.compile(r"^Align failed for (.*)$")
+skipped_re = re.compile(r"^Sizes differing too much\.")
+
+def batch_chunks(batch_filename):
+    """Returns the output (ladder) filenames listed in a hunalign
+    batch file."""
+    with open(batch_filename) as batch_file:
+        return [line.rstrip("\n").split("\t")[-1] for line in batch_file if line.strip()]
+
+def run_hunalign(hunalign_args, stage, telemetry, echo=True, expected=()):
+    """Runs hunalign, passing its stderr through (unless echo is
+    False) while parsing its progress and quality lines into
+    telemetry records. Returns the list of chunk records.
+
+    Chunks in expected that hunalign never reported on, e.g.
+    because it crashed, are recorded as failed.
+
+    The resource usage of the child is taken from wait4. Per-chunk
+    wall time is measured between consecutive "Processing" lines."""
+    start = time.monotonic()
+    process = subprocess.Popen(hunalign_args, stderr=subprocess.PIPE,
+                               universal_newlines=True, errors="replace")
+    chunk = None
+    chunks = []
+
+    def finish_chunk(now):
+        chunk["wall_time"] = now - chunk.pop("start")
+        # A chunk that never reported its quality was not aligned.
+        if chunk["quality"] is None:
+            chunk["failed"] = True
+        telemetry.record(chunk)
+        chunks.append(chunk)
+
+    for line in process.stderr:
+        if echo:
+            sys.stderr.write(line)
+        line = line.rstrip("\n")
+        now = time.monotonic()
+        m = processing_re.match(line)
+        if m:
+            if chunk:
+                finish_chunk(now)
+            chunk = {"event": "chunk", "stage": stage, "chunk": m.group(1),
+                     "start": now, "sentences": [None, None],
+                     "quality": None, "failed": False}
+            continue
+        if chunk is None:
+            continue
+        m = sentences_re.match(line)
+        if m:
+            chunk["sentences"][0 if m.group(2) == "hungarian" else 1] = int(m.group(1))
+            continue
+        m = quality_re.match(line)
+        if m:
+            chunk["quality"] = float(m.group(2))
+            continue
+        if failed_re.match(line) or skipped_re.match(line):
+            chunk["failed"] = True
+    if chunk:
+        finish_chunk(time.monotonic())
+    process.stderr.close()
+    reported = set(c["chunk"] for c in chunks)
+    for name in expected:
+        if name not in reported:
+            chunk = {"event": "chunk", "stage": stage, "chunk": name,
+                     "wall_time": None, "sentences": [None, None],
+                     "quality": None, "failed": True}
+            telemetry.record(chunk)
+            chunks.append(chunk)
+
+    pid, status, rusage = os.wait4(process.pid, 0)
+    wall_time = time.monotonic() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+
+    sentences = sum(sum(s for s in c["sentences"] if s) for c in chunks if not c["failed"])
+    telemetry.record({
+        "event": "process", "stage": stage, "args": list(hunalign_args),
+        "returncode": process.returncode, "wall_time": wall_time,
+        "user_time": rusage.ru_utime, "system_time": rusage.ru_stime,
+        "max_rss": rusage.ru_maxrss * 1024, # kilobytes on Linux
+        "chunks": len(chunks),
+        "chunks_failed": sum(1 for c in chunks if c["failed"]),
+        "sentences": sentences,
+        "sentences_per_second": sentences / wall_time if wall_time > 0 else None})
+    return chunks
+
+def ladder_stats(ladder):
+    """Returns the mean score of the rungs of a ladder and the length
+    of its longest run of 1-0 or 0-1 rungs."""
+    scores = [float(rung[2]) for rung in ladder[:-1]]
+    longest = run = 0
+    for a, b in pairwise(ladder):
+        if a[0] == b[0] or a[1] == b[1]:
+            run += 1
+            longest = max(longest, run)
+        else:
+            run = 0
+    return (sum(scores) / len(scores) if scores else 0.0), longest
+
+def weak_chunks(batch_lines, threshold, maxrun):
+    """Selects the lines of a hunalign batch file whose alignment
+    is doubtful, i.e. whose ladder has a mean score below threshold
+    or a run of more than maxrun 1-0/0-1 rungs. Chunks without a
+    readable ladder are always selected."""
+    weak = []
+    for line in batch_lines:
+        ladder_filename = line.split("\t")[2]
+        try:
+            score, longest = ladder_stats(readLadder(ladder_filename))
+        except (OSError, ValueError, AssertionError):
+            weak.append(line)
+            continue
+        if score < threshold or longest > maxrun:
+            logging.debug('%s selected for realignment (score %f, longest run %d).',
+                          ladder_filename, score, longest)
+            weak.append(line)
+    return weak
+
+def merge_dictionaries(autodict_filename, merged_filename):
+    """Merges the per-chunk dictionaries hunalign appends to its
+    autodict file into a single dictionary without duplicates."""
+    seen = set()
+    with open(autodict_filename) as autodict, open(merged_filename, "w") as merged:
+        for line in autodict:
+            if line.startswith("---STARTING-NEW-FILE") or line in seen:
+                continue
+            seen.add(line)
+            merged.write(line)
+    return len(seen)
 
 def main():
     """This does the actual work of the script, i.e. it executes
     partialAlign and hunalign according to the command line
     arguments."""
 
-    partialAlign_args, partialAlign, hunalign, realign, accumulate = mangle_args(sys.argv)
+    (partialAlign_args, partialAlign, hunalign, realign, accumulate,
+     selective, threshold, maxrun, jsonlog, metrics) = mangle_args(sys.argv)
     if partialAlign_args == None or len(sys.argv) == 1:
         print(("This script splits a corpus into manageable chunks using \n"
                "partialAlign2.py then aligns it using hunalign. \n"
                "If --realign is specified, hunalign re-aligns each chunk \n"
                "using a dictionary generated from its first alignment. \n"
                "With --accumulate, the dictionaries are combined and the \n"
-               "final dictionary is used to realign all chunks. \n\n"
+               "final dictionary is used to realign all chunks. \n"
+               "With --selective, only the chunks whose ladder has a mean \n"
+               "score below --threshold (default 0.5) or a run of more \n"
+               "than --maxrun (default 5) 1-0/0-1 rungs are realigned \n"
+               "with the combined dictionary. \n"
+               "--jsonlog writes a JSON record per chunk and per hunalign \n"
+               "process, --metrics writes the same data in Prometheus \n"
+               "text format. \n\n"
                "Usage: {0} \n"
                "       [--partialAlign=/path/to/partialAlign2.py] \n"
                "       [--hunalign=/path/to/hunalign] \n"
                "       [--realign] \n"
                "       [--accumulate] \n"
+               "       [--selective [--threshold=T] [--maxrun=N]] \n"
+               "       [--jsonlog=/path/to/log.jsonl] \n"
+               "       [--metrics=/path/to/metrics.prom] \n"
                "       PARTIALALIGN-ARGUMENTS... \n\n"
                "If partialAlign is in the correct location, its argument \n"
                "list will now be shown. \n").format(sys.argv[0]))
         process = subprocess.Popen((partialAlign, "--help"))
         process.wait()
         return
-    
+
     partialAlign_args[0] = partialAlign
     with open("hunalign_batch", "w") as batch_file:
         process = subprocess.Popen(partialAlign_args, stdout=batch_file)
         process.wait()
         if process.returncode != 0:
             raise RuntimeError("Partial align failed")
-    
+
+    telemetry = Telemetry(jsonlog)
+    try:
+        align(hunalign, realign, accumulate, selective, threshold, maxrun, telemetry)
+    finally:
+        telemetry.close()
+        if metrics:
+            telemetry.write_metrics(metrics)
+
+    failed = telemetry.failed_chunks()
+    for c in failed:
+        logging.error('HunAlign failed to align %s (%s pass).', c["chunk"], c["stage"])
+    stages = collections.OrderedDict()
+    for c in telemetry.chunks:
+        counts = stages.setdefault(c["stage"], [0, 0])
+        counts[1 if c["failed"] else 0] += 1
+    for stage, counts in stages.items():
+        logging.info('%s pass: %d chunks aligned, %d failed.', stage, counts[0], counts[1])
+    if failed:
+        sys.exit(1)
+
+def align(hunalign, realign, accumulate, selective, threshold, maxrun, telemetry):
+    """Runs hunalign on the chunks listed in hunalign_batch, and
+    realigns them as requested."""
     # Run HunAlign once to generate a dictionary
-    if realign: 
+    if realign:
         try:
             os.remove("autodict")
         except OSError:
@@ -90,22 +404,31 @@ def main():
                          "-batch", "/dev/null", "hunalign_batch")
     else:
         hunalign_args = (hunalign, "-batch", "/dev/null", "hunalign_batch")
-    process = subprocess.Popen(hunalign_args)
-    process.wait()
-    # HunAlign always returns nonzero, god bless its kind soul
-    #if process.returncode != 0:
-    #    raise RuntimeError("HunAlign failed")
-    
-    if accumulate:
+    run_hunalign(hunalign_args, "align", telemetry, expected=batch_chunks("hunalign_batch"))
+    # HunAlign always returns nonzero, god bless its kind soul, so
+    # we judge success by the chunks it reported on instead.
+
+    if selective:
+        # Run it again with the combined dictionary, but only on the
+        # chunks that did not align confidently the first time
+        with open("hunalign_batch") as batch_file:
+            batch_lines = [line.rstrip("\n") for line in batch_file if line.strip()]
+        weak = weak_chunks(batch_lines, threshold, maxrun)
+        logging.info('%d of %d chunks selected for realignment.', len(weak), len(batch_lines))
+        if weak and not os.path.exists("autodict"):
+            logging.warning('No dictionary was generated, skipping realignment.')
+        elif weak:
+            merge_dictionaries("autodict", "autodict_merged")
+            with open("hunalign_batch_weak", "w") as batch_file:
+                # No newline after the last line, or hunalign complains about the format.
+                batch_file.write("\n".join(weak))
+            hunalign_args = (hunalign, "-batch", "autodict_merged", "hunalign_batch_weak")
+            run_hunalign(hunalign_args, "realign", telemetry,
+                         expected=batch_chunks("hunalign_batch_weak"))
+    elif accumulate:
         # Run it again, now using this generated dictionary
         hunalign_args = (hunalign, "-batch", "autodict", "hunalign_batch")
-        process = subprocess.Popen(hunalign_args)
-        process.wait()
-
-    # And yet again we don't know if it really finished, so let's tell the user
-    print("\nPlease check the output for errors. HunAlign always finishes \n"
-          "with an error code, so the script can't automatically do that \n"
-          "for you. (Not reliably, at least.)")
+        run_hunalign(hunalign_args, "realign", telemetry, expected=batch_chunks("hunalign_batch"))
 
 if __name__ == "__main__":
     main()